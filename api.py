@@ -20,38 +20,233 @@ Copyright (C) 2024 foorensic
 from __future__ import annotations
 
 import asyncio
-import ipaddress
 import logging
 import os
+import re
 import secrets
-import tempfile
+import socket
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager, suppress
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
-from typing import Annotated, Any
+from typing import Annotated, Final
 
+import orjson
 import tomllib
 from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, status
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import HTMLResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel, constr
-
-with Path("pyproject.toml").open("rb") as file_handle:
-    project_toml = tomllib.load(file_handle)
-    PROJECT_NAME = project_toml.get("tool", {}).get("poetry", {}).get("name", "")
-    PROJECT_VERSION = project_toml.get("tool", {}).get("poetry", {}).get("version", "")
-
-AUTH_USER = os.environ["AUTH_USER"]  # This intentionally
-AUTH_PASS = os.environ["AUTH_PASS"]  # raises a KeyError
-RECORD_TTL = os.environ.get("RECORD_TTL", "3600")
-ZONE = os.environ.get("ZONE", "").strip(". ")
-NSUPDATE = "/usr/bin/nsupdate"
+from starlette.datastructures import State
+
+AUTH_USER: Final = os.environ["AUTH_USER"]  # This intentionally
+AUTH_PASS: Final = os.environ["AUTH_PASS"]  # raises a KeyError
+AUTH_USER_BYTES: Final = AUTH_USER.encode("utf8")
+AUTH_PASS_BYTES: Final = AUTH_PASS.encode("utf8")
+RECORD_TTL: Final = os.environ.get("RECORD_TTL", "3600")
+ZONE: Final = os.environ.get("ZONE", "").strip(". ")
+MAX_HOSTS: Final = 32
+NSUPDATE: Final = "/usr/bin/nsupdate"
+NSUPDATE_TIMEOUT: Final = 30
+UPDATE_BATCH_DELAY: Final = 0.05
+UPDATE_BATCH_SIZE: Final = 32
+UPDATE_BATCH_BYTES: Final = 32768
+CONTROL_CHARS: Final = re.compile(r"[\x00-\x1f\x7f]")
+UPDATE_HEADER: Final = f"server 127.0.0.1\nzone {ZONE}\n".encode()
 
 logger = logging.getLogger("uvicorn.error")
 security = HTTPBasic()
 
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+async def start_nsupdate() -> asyncio.subprocess.Process:
+    """Start a long-lived nsupdate process reading update commands from stdin."""
+    return await asyncio.create_subprocess_exec(
+        NSUPDATE,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+
+
+async def stop_nsupdate(proc: asyncio.subprocess.Process | None) -> None:
+    """Ask the nsupdate process to quit, killing it if it does not."""
+    if proc is None or proc.returncode is not None:
+        return
+    try:
+        proc.stdin.write(b"quit\n")
+        await proc.stdin.drain()
+        await asyncio.wait_for(proc.wait(), NSUPDATE_TIMEOUT)
+    except (OSError, TimeoutError):
+        with suppress(ProcessLookupError):
+            proc.kill()
+        await proc.wait()
+
+
+class NameserverError(Exception):
+    """nsupdate could not communicate with the nameserver."""
+
+
+async def read_answer(stdout: asyncio.StreamReader) -> tuple[bool, list[str]]:
+    """Read nsupdate output up to the end of the next answer message.
+
+    Errors are printed before the answer, so the update only succeeded if the
+    output starts with the answer and its status is NOERROR. An ``update failed:``
+    line ends the result early, and a ``; Communication with`` line (no reply,
+    so there is no answer to wait for) raises NameserverError.
+
+    The expected format is that of BIND 9.18 nsupdate (alpine 3.20): the answer
+    is ``Answer:``, the ``;; ->>HEADER<<-`` line and its sections, terminated by
+    a blank line. It has only been checked against that format as documented,
+    not against a live nsupdate.
+    """
+    output = []
+    rcode = ""
+    while True:
+        raw_line = await stdout.readline()
+        if not raw_line:
+            raise ConnectionError("nsupdate exited unexpectedly")
+        line = raw_line.decode("utf-8", "replace").rstrip("\n")
+        if rcode and not line:
+            break
+        if line.startswith("; Communication with"):
+            raise NameserverError(line)
+        output.append(line)
+        if line.startswith("update failed:"):
+            return False, output
+        if line.startswith(";; ->>HEADER<<-"):
+            rcode = line.partition("status: ")[2].partition(",")[0]
+    return output[0] == "Answer:" and rcode == "NOERROR", output
+
+
+async def discard_nsupdate(state: State, proc: asyncio.subprocess.Process) -> None:
+    """Kill nsupdate so the next update starts over with a fresh process."""
+    state.nsupdate = None
+    with suppress(ProcessLookupError):
+        proc.kill()
+    await proc.wait()
+
+
+async def run_nsupdate(state: State, update: bytes) -> tuple[bool, list[str]]:
+    """Send update commands to the persistent nsupdate process and wait for the answer."""
+    if state.nsupdate is None or state.nsupdate.returncode is not None:
+        state.nsupdate = await start_nsupdate()
+    proc = state.nsupdate
+    try:
+        proc.stdin.writelines((update, b"answer\n"))
+        await proc.stdin.drain()
+        success, output = await asyncio.wait_for(read_answer(proc.stdout), NSUPDATE_TIMEOUT)
+    except BaseException:
+        # The output stream is out of sync now
+        await discard_nsupdate(state, proc)
+        raise
+    if not success:
+        # nsupdate may still print the rest of a failed update, which must not
+        # be read as the answer to the next one
+        await discard_nsupdate(state, proc)
+    return success, output
+
+
+async def send_batch(state: State, batch: list[tuple[bytes, asyncio.Future]]) -> tuple[bool, list[str]] | Exception:
+    """Send queued updates as one nsupdate transaction and return its result or error."""
+    update = b"".join([UPDATE_HEADER, *(commands for commands, _ in batch), b"send\n"])
+    try:
+        return await run_nsupdate(state, update)
+    except Exception as exc:  # noqa: BLE001
+        return exc
+
+
+def is_update_error(result: tuple[bool, list[str]] | Exception) -> bool:
+    """Return whether a failed transaction may be caused by one of its updates.
+
+    That is an error answer, or nsupdate exiting (e.g. on a syntax error).
+    Timeouts and nameserver communication failures would fail every update again.
+    """
+    if isinstance(result, Exception):
+        return isinstance(result, ConnectionError)
+    return not result[0]
+
+
+def resolve_update(future: asyncio.Future, result: tuple[bool, list[str]] | Exception) -> None:
+    """Hand a transaction result or error to a waiting caller."""
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+async def process_updates(state: State) -> None:
+    """Coalesce queued updates into single nsupdate transactions.
+
+    After the first update arrives, further updates are collected for up to
+    UPDATE_BATCH_DELAY seconds and sent together, bounded by UPDATE_BATCH_SIZE
+    updates and UPDATE_BATCH_BYTES of commands. If the shared transaction
+    fails because of one of its updates, each update is retried on its own so
+    every caller gets its own result.
+    """
+    loop = asyncio.get_running_loop()
+    pending = None
+    while True:
+        batch = [pending or await state.update_queue.get()]
+        pending = None
+        size = len(batch[0][0])
+        deadline = loop.time() + UPDATE_BATCH_DELAY
+        while len(batch) < UPDATE_BATCH_SIZE and (timeout := deadline - loop.time()) > 0:
+            try:
+                item = await asyncio.wait_for(state.update_queue.get(), timeout)
+            except TimeoutError:
+                break
+            size += len(item[0])
+            if size > UPDATE_BATCH_BYTES:
+                # Keep it for the next transaction
+                pending = item
+                break
+            batch.append(item)
+
+        result = await send_batch(state, batch)
+        if len(batch) > 1 and is_update_error(result):
+            for item in batch:
+                # Skip callers that are gone already
+                if not item[1].done():
+                    resolve_update(item[1], await send_batch(state, [item]))
+        else:
+            for _, future in batch:
+                resolve_update(future, result)
+
+
+async def submit_update(state: State, commands: bytes) -> tuple[bool, list[str]]:
+    """Queue update commands for the next nsupdate transaction and wait for its result."""
+    future = asyncio.get_running_loop().create_future()
+    state.update_queue.put_nowait((commands, future))
+    return await future
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Keep one nsupdate process and its update queue running for the lifetime of the app."""
+    # Build the cached OpenAPI spec now, so no request reads pyproject.toml
+    get_openapi_json()
+    app.state.nsupdate = await start_nsupdate()
+    app.state.update_queue = asyncio.Queue()
+    update_worker = asyncio.create_task(process_updates(app.state))
+    yield
+    update_worker.cancel()
+    with suppress(asyncio.CancelledError):
+        await update_worker
+    await stop_nsupdate(app.state.nsupdate)
+
+
+app = FastAPI(
+    docs_url=None,
+    redoc_url=None,
+    openapi_url=None,
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 router = APIRouter(prefix="/api/v1")
 
 
@@ -76,30 +271,50 @@ class MethodType(str, Enum):
     delete = "delete"
 
 
-HostType = constr(
-    pattern=r"^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$",
-)
+# Pydantic matches this with its Rust regex engine (linear time, no backtracking),
+# the pattern is compiled once when the route's schema is built.
+HOST_LABEL_PATTERN = r"[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?"
+HostType = constr(pattern=rf"^(?:{HOST_LABEL_PATTERN}\.)*{HOST_LABEL_PATTERN}$")
 
 
-def is_valid_ip(address: str) -> bool:
-    """Validate IP address."""
+@lru_cache(maxsize=1024)
+def canonical_ip(address: str) -> str | None:
+    """Return the canonical text form of an IP address, or None if it is invalid."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_ntop(family, socket.inet_pton(family, address))
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_documentation_html() -> bytes:
+    """Return the rendered Swagger UI page."""
+    return get_swagger_ui_html(openapi_url="/openapi.json", title="Dynamic DNS API").body
+
+
+@lru_cache(maxsize=1)
+def get_openapi_json() -> bytes:
+    """Return the serialized OpenAPI specification, generated on first use."""
     try:
-        ipaddress.ip_address(address)
-    except ValueError:
-        return False
-    return True
+        with Path("pyproject.toml").open("rb") as file_handle:
+            project = tomllib.load(file_handle).get("tool", {}).get("poetry", {})
+    except OSError:
+        logger.warning("Could not read pyproject.toml, OpenAPI title and version will be empty")
+        project = {}
+    openapi = get_openapi(title=project.get("name", ""), version=project.get("version", ""), routes=app.routes)
+    return orjson.dumps(openapi)
 
 
-def get_current_username(
+async def get_current_username(
     credentials: Annotated[HTTPBasicCredentials, Depends(security)],
 ) -> str:
     """Validate user and return username."""
     current_username_bytes = credentials.username.encode("utf8")
-    correct_username_bytes = AUTH_USER.encode("utf8")
-    is_correct_username = secrets.compare_digest(current_username_bytes, correct_username_bytes)
+    is_correct_username = secrets.compare_digest(current_username_bytes, AUTH_USER_BYTES)
     current_password_bytes = credentials.password.encode("utf8")
-    correct_password_bytes = AUTH_PASS.encode("utf8")
-    is_correct_password = secrets.compare_digest(current_password_bytes, correct_password_bytes)
+    is_correct_password = secrets.compare_digest(current_password_bytes, AUTH_PASS_BYTES)
     if not (is_correct_username and is_correct_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -109,89 +324,105 @@ def get_current_username(
     return credentials.username
 
 
-@router.get("/{record_type}/{method}", summary="Update/Delete Records", response_model=ApiResponse)
+async def get_client_ip(request: Request) -> str:
+    """Return the client IP (resolved from proxy headers by uvicorn)."""
+    client = request.scope.get("client")
+    return client[0] if client else ""
+
+
+@router.get(
+    "/{record_type}/{method}",
+    summary="Update/Delete Records",
+    response_model=None,
+    responses={status.HTTP_200_OK: {"model": ApiResponse}},
+)
 async def update_record(
     request: Request,
     username: Annotated[str, Depends(get_current_username)],  # noqa: ARG001
+    client_ip: Annotated[str, Depends(get_client_ip)],
     record_type: RecordType,
     method: MethodType,
-    host: Annotated[list[HostType], Query()],
+    host: Annotated[list[HostType], Query(min_length=1, max_length=MAX_HOSTS)],
     value: Annotated[str | None, Query()] = "",
-) -> dict:
+) -> ORJSONResponse:
     """Update or delete a DNS record."""
     value = value.strip(" \"'") if value else ""
     record_value = ""
 
+    # Values are written to nsupdate's stdin, a line break would inject commands
+    if CONTROL_CHARS.search(value):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Value contains control characters")
+
     if record_type == RecordType.A:
         # User provided IP?
         if value:
-            if not is_valid_ip(value):
+            record_value = canonical_ip(value)
+            if record_value is None:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Value for A record is not a valid IP",
                 )
-            record_value = value
-        else:
-            record_value = request.client.host
+        elif client_ip:
+            record_value = client_ip
+        elif method == MethodType.update:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Client IP unknown, provide a value for the A record",
+            )
 
     elif record_type == RecordType.TXT:
         if method == MethodType.update and not value:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="TXT record value cannot be empty")
         if value:
-            value = value.replace('"', '\\"')
+            # ACME tokens and most other TXT values contain nothing to escape
+            if '"' in value or "\\" in value:
+                value = value.replace("\\", "\\\\").replace('"', '\\"')
             record_value = f'"{value}"'
 
-    # Create the update file
-    file_content = "server 127.0.0.1\n"
-    file_content += f"zone {ZONE}\n"
+    # Create the update commands
+    delete_suffix = f".{ZONE} {record_type.value}\n".encode()
+    add_suffix = f".{ZONE} {RECORD_TTL} {record_type.value} {record_value}\n".encode()
+    is_update = method == MethodType.update
+    chunks = []
     for record_host in host:
-        file_content += f"update delete {record_host}.{ZONE} {record_type.value}\n"
-        if method == MethodType.update:
-            file_content += f"update add {record_host}.{ZONE} {RECORD_TTL} {record_type.value} {record_value}\n"
-    file_content += "send\n"
+        encoded_host = record_host.encode()
+        chunks += (b"update delete ", encoded_host, delete_suffix)
+        if is_update:
+            chunks += (b"update add ", encoded_host, add_suffix)
 
-    update_file = Path(tempfile.gettempdir()) / "nsupdate.txt"
-    update_file.write_text(file_content, "utf-8")
-
-    command = [NSUPDATE, update_file.as_posix()]
     try:
-        proc = await asyncio.create_subprocess_exec(
-            *command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, stderr = await proc.communicate()
+        success, output = await submit_update(request.app.state, b"".join(chunks))
     except Exception:
-        logger.exception("Failed running %s:", command)
+        logger.exception("Failed running %s:", NSUPDATE)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occured.") from None
 
-    if proc.returncode != 0:
-        logger.error("Failed running %s (%s): stdout: %s, stderr: %s", command, proc.returncode, stdout, stderr)
+    if not success:
+        logger.error("Failed running %s: %s", NSUPDATE, output)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occured.")
 
     message = f"Updated record: {host} {record_type.value} {record_value}"
     if method == MethodType.delete:
         message = f"Deleted record: {host} {record_type.value}"
     logger.info(message)
-    return {"success": True, "message": message}
+    return ORJSONResponse({"success": True, "message": message})
 
 
 @router.get("/ip", summary="Client IP", response_class=PlainTextResponse)
-def get_ip(request: Request) -> str:
+async def get_ip(client_ip: Annotated[str, Depends(get_client_ip)]) -> Response:
     """Return client IP."""
-    return request.client.host
+    return Response(client_ip.encode(), media_type="text/plain")
 
 
 @app.get("/docs", summary="OpenAPI Documentation", include_in_schema=False)
-def get_documentation(username: str = Depends(get_current_username)) -> HTMLResponse:  # noqa: ARG001
+async def get_documentation(username: str = Depends(get_current_username)) -> HTMLResponse:  # noqa: ARG001
     """Return Swagger OpenAPI documentation of this endpoint."""
-    return get_swagger_ui_html(openapi_url="/openapi.json", title="Dynamic DNS API")
+    return HTMLResponse(get_documentation_html())
 
 
 @app.get("/openapi.json", summary="OpenAPI JSON", include_in_schema=False)
-def openapi_json(username: str = Depends(get_current_username)) -> dict[str, Any]:  # noqa: ARG001
+async def openapi_json(username: str = Depends(get_current_username)) -> Response:  # noqa: ARG001
     """Return the OpenAPI JSON specification of this API."""
-    return get_openapi(title=PROJECT_NAME, version=PROJECT_VERSION, routes=app.routes)
+    return Response(get_openapi_json(), media_type="application/json")
 
 
 app.include_router(router)
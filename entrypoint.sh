@@ -25,6 +25,7 @@ set -e
 [ -z "$AUTH_USER" ] && echo "ERROR: \$AUTH_USER env var is not set" && exit 1;
 [ -z "$AUTH_PASS" ] && echo "ERROR: \$AUTH_PASS env var is not set" && exit 1;
 RECORD_TTL=${RECORD_TTL:-3600}
+WORKERS=${WORKERS:-$(nproc)}
 
 
 # Add zone to named.conf if it does not exist
@@ -68,4 +69,5 @@ chmod 644 /var/bind/*
 
 named -fg -4 -u named -c /etc/bind/named.conf &
 
-exec poetry run uvicorn --host 0.0.0.0 --port 5000 --no-server-header --proxy-headers --forwarded-allow-ips "*" api:app
+exec poetry run uvicorn --host 0.0.0.0 --port 5000 --no-server-header --proxy-headers --forwarded-allow-ips "*" \
+     --loop uvloop --http httptools --workers "$WORKERS" api:app
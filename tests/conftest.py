@@ -0,0 +1,8 @@
+"""Dynamic DNS Server - test configuration."""
+
+import os
+
+# api reads its settings from the environment on import
+os.environ.setdefault("AUTH_USER", "user")
+os.environ.setdefault("AUTH_PASS", "pass")
+os.environ.setdefault("ZONE", "dynamic.example.com")
@@ -0,0 +1,144 @@
+"""Dynamic DNS Server - API tests."""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import api
+
+# Output of BIND 9.18 nsupdate for the "answer" command
+ANSWER_NOERROR = (
+    b"Answer:\n"
+    b";; ->>HEADER<<- opcode: UPDATE, status: NOERROR, id:  52787\n"
+    b";; flags: qr aa; ZONE: 1, PREREQ: 0, UPDATE: 0, ADDITIONAL: 0\n"
+    b";; ZONE SECTION:\n"
+    b";dynamic.example.com.\t\tIN\tSOA\n"
+    b"\n"
+)
+ANSWER_REFUSED = ANSWER_NOERROR.replace(b"status: NOERROR", b"status: REFUSED")
+
+
+def read_answer(data: bytes) -> tuple[tuple[bool, list[str]], bytes]:
+    """Run read_answer on data, return its result and the unread rest of the data."""
+
+    async def main() -> tuple[tuple[bool, list[str]], bytes]:
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await api.read_answer(reader), await reader.read()
+
+    return asyncio.run(main())
+
+
+def test_read_answer_noerror() -> None:
+    (success, output), rest = read_answer(ANSWER_NOERROR + ANSWER_NOERROR)
+    assert success
+    assert output[0] == "Answer:"
+    assert rest == ANSWER_NOERROR
+
+
+def test_read_answer_update_failed() -> None:
+    (success, output), _ = read_answer(b"update failed: REFUSED\n" + ANSWER_REFUSED)
+    assert not success
+    assert output == ["update failed: REFUSED"]
+
+
+def test_read_answer_error_status() -> None:
+    (success, _), _ = read_answer(ANSWER_REFUSED)
+    assert not success
+
+
+def test_read_answer_communication_failed() -> None:
+    with pytest.raises(api.NameserverError):
+        read_answer(b"; Communication with 127.0.0.1#53 failed: timed out\n")
+
+
+def test_read_answer_exited() -> None:
+    with pytest.raises(ConnectionError):
+        read_answer(b"syntax error\n")
+
+
+# Stub for nsupdate: answers every "answer" command like nsupdate, exits on
+# hosts named "fatal" like nsupdate on a syntax error, refuses hosts named
+# "refused" and never replies at all for hosts named "silent"
+NSUPDATE_STUB = """#!{python}
+import sys, time
+
+status = "NOERROR"
+for line in sys.stdin:
+    if line.strip() == "quit":
+        break
+    if "fatal." in line:
+        sys.exit(1)
+    if "refused." in line:
+        status = "REFUSED"
+    if "silent." in line:
+        time.sleep(60)
+    if "unreachable." in line:
+        print("; Communication with 127.0.0.1#53 failed: timed out", flush=True)
+    if line.strip() == "answer":
+        if status != "NOERROR":
+            print(f"update failed: {{status}}", flush=True)
+        print({answer!r}.replace("NOERROR", status), end="", flush=True)
+        status = "NOERROR"
+"""
+
+
+@pytest.fixture()
+def nsupdate_stub(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Run updates against the nsupdate stub."""
+    stub = tmp_path / "nsupdate"
+    stub.write_text(NSUPDATE_STUB.format(python=sys.executable, answer=ANSWER_NOERROR.decode()))
+    stub.chmod(0o755)
+    monkeypatch.setattr(api, "NSUPDATE", str(stub))
+
+
+def submit_updates(*hosts: str) -> list[bool | BaseException]:
+    """Submit concurrent updates for hosts, return whether each succeeded or its error."""
+
+    async def main() -> list[tuple[bool, list[str]] | BaseException]:
+        async with api.lifespan(api.app):
+            return await asyncio.gather(
+                *(api.submit_update(api.app.state, f"update delete {host}.{api.ZONE} A\n".encode()) for host in hosts),
+                return_exceptions=True,
+            )
+
+    return [result if isinstance(result, BaseException) else result[0] for result in asyncio.run(main())]
+
+
+@pytest.mark.usefixtures("nsupdate_stub")
+def test_batch_success() -> None:
+    assert submit_updates("host1", "host2", "host3") == [True, True, True]
+
+
+@pytest.mark.usefixtures("nsupdate_stub")
+def test_batch_with_fatal_update() -> None:
+    results = submit_updates("host1", "fatal", "host2")
+    assert results[0] is True
+    assert isinstance(results[1], ConnectionError)
+    assert results[2] is True
+
+
+@pytest.mark.usefixtures("nsupdate_stub")
+def test_batch_with_refused_update() -> None:
+    assert submit_updates("host1", "refused", "host2") == [True, False, True]
+
+
+@pytest.mark.usefixtures("nsupdate_stub")
+def test_batch_timeout_is_not_retried(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(api, "NSUPDATE_TIMEOUT", 0.5)
+    start = time.monotonic()
+    results = submit_updates("host1", "silent", "host2", "host3")
+    assert all(isinstance(result, TimeoutError) for result in results)
+    assert time.monotonic() - start < 2 * api.NSUPDATE_TIMEOUT
+
+
+@pytest.mark.usefixtures("nsupdate_stub")
+def test_batch_communication_failure_is_not_retried() -> None:
+    start = time.monotonic()
+    results = submit_updates("host1", "unreachable", "host2")
+    assert all(isinstance(result, api.NameserverError) for result in results)
+    assert time.monotonic() - start < 1